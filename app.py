@@ -1,11 +1,22 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, flash, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, session, g
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from flask_caching import Cache
+from jinja2 import FileSystemBytecodeCache
 import sqlite3
 import csv
+import json
 import io
+import os
+import queue
+import re
+import zlib
 from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from functools import wraps
+from itertools import groupby
+from operator import itemgetter
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'My_secret_key_is_secret'  # Change this in production!
@@ -17,6 +28,34 @@ login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
 
+# Compiled templates are kept on disk (in a private temp directory), so new worker
+# processes load them instead of parsing and compiling every template again
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+# In-process cache for rendered pages and logged-in users
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
+
+# Argon2id password hashing (parameters are stored in each hash)
+password_hasher = PasswordHasher()
+
+# Seconds a loaded user is reused before it's read from the database again. Kept short
+# because the cache is per process - a deletion in one worker is only seen by the others
+# once their copy expires.
+USER_CACHE_TIMEOUT = 60
+
+# Maximum number of pooled SQLite connections of each kind (read-only and read-write),
+# per process. Set DB_POOL_SIZE to the WSGI server's thread count.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+
+# Rows pulled from the cursor (and written out) per chunk of a CSV export
+CSV_BATCH_SIZE = 1000
+
+# Bump whenever init_db() changes the schema (stored in PRAGMA user_version)
+SCHEMA_VERSION = 9
+
+# INSERT ... RETURNING needs SQLite 3.35+
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
 # Exercise data based on muscle groups
 EXERCISES = {
     'Chest': ['Bench Press', 'Incline Bench Press', 'Decline Bench Press', 'Dumbbell Flyes', 'Push-ups', 'Cable Crossover'],
@@ -27,6 +66,127 @@ EXERCISES = {
     'Core': ['Plank', 'Crunches', 'Russian Twists', 'Leg Raises', 'Mountain Climbers', 'Bicycle Crunches']
 }
 
+# Pre-serialized /exercises responses - EXERCISES never changes at runtime
+_EXERCISE_JSON = {group: json.dumps({'exercises': exercises}) for group, exercises in EXERCISES.items()}
+_EMPTY_EXERCISE_JSON = json.dumps({'exercises': []})
+# ETags only need to tell the bodies apart - CRC-32 is enough, and unlike md5 it's never
+# disabled on FIPS-mode OpenSSL builds
+_EXERCISE_ETAGS = {group: f'{zlib.crc32(body.encode()):08x}' for group, body in _EXERCISE_JSON.items()}
+_EMPTY_EXERCISE_ETAG = f'{zlib.crc32(_EMPTY_EXERCISE_JSON.encode()):08x}'
+
+# Submitted set fields look like set_1_reps, set_1_weight, set_2_reps, ...
+_SET_RE = re.compile(r'set_(\d+)_(reps|weight)$')
+
+# Hot-path SQL. Kept as module-level constants so every call passes the exact same
+# text and hits the connection's prepared-statement cache.
+RETURNING_ID = ' RETURNING id' if SQLITE_HAS_RETURNING else ''
+
+SQL_ACTIVE_SESSION = '''
+    SELECT id, date, start_time
+    FROM sessions
+    WHERE user_id = ? AND end_time IS NULL
+    ORDER BY date DESC, start_time DESC
+    LIMIT 1
+'''
+
+# Write paths only need the id
+SQL_ACTIVE_SESSION_ID = '''
+    SELECT id FROM sessions
+    WHERE user_id = ? AND end_time IS NULL
+    ORDER BY date DESC, start_time DESC
+    LIMIT 1
+'''
+
+SQL_LAST_COMPLETED_SESSION = '''
+    SELECT id, date, start_time, end_time, duration_minutes
+    FROM sessions
+    WHERE user_id = ? AND end_time IS NOT NULL
+    ORDER BY date DESC, end_time DESC
+    LIMIT 1
+'''
+
+SQL_SESSION_WORKOUTS_WITH_SETS = '''
+    SELECT w.id, w.date, w.time, w.muscle_group, w.exercise,
+           s.set_number, s.reps, s.weight_kg
+    FROM workouts w
+    LEFT JOIN workout_sets s ON s.workout_id = w.id
+    WHERE w.session_id = ? AND w.user_id = ?
+    ORDER BY w.time, w.id, s.set_number
+'''
+
+# date/start_time come from the column defaults
+SQL_INSERT_SESSION = '''
+    INSERT INTO sessions (user_id)
+    VALUES (?)
+''' + RETURNING_ID
+
+# Finds and ends the user's active session in one statement
+SQL_END_ACTIVE_SESSION = '''
+    UPDATE sessions
+    SET end_time = strftime('%H:%M:%S', 'now', 'localtime'),
+        duration_minutes = (julianday(strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime'))
+                            - julianday(date || ' ' || start_time)) * 1440.0
+    WHERE id = (
+        SELECT id FROM sessions
+        WHERE user_id = ? AND end_time IS NULL
+        ORDER BY date DESC, start_time DESC
+        LIMIT 1
+    )
+'''
+
+# date/time come from the column defaults
+SQL_INSERT_WORKOUT = '''
+    INSERT INTO workouts (user_id, muscle_group, exercise, session_id)
+    VALUES (?, ?, ?, ?)
+''' + RETURNING_ID
+
+SQL_INSERT_SET = '''
+    INSERT INTO workout_sets (workout_id, set_number, reps, weight_kg)
+    VALUES (?, ?, ?, ?)
+'''
+
+# Run by the user loader on every authenticated request
+SQL_USER_BY_ID = 'SELECT id, username, email, is_admin FROM users WHERE id = ?'
+
+SQL_USER_BY_USERNAME = 'SELECT id, username, email, password_hash, is_admin FROM users WHERE username = ?'
+
+# CSV export - one row per set, workouts without sets come back with NULL set columns
+SQL_EXPORT_ALL_WORKOUTS = '''
+    SELECT w.id, w.date, w.time, w.muscle_group, w.exercise, w.user_id, u.username,
+           s.set_number, s.reps, s.weight_kg
+    FROM workouts w
+    LEFT JOIN workout_sets s ON s.workout_id = w.id
+    LEFT JOIN users u ON u.id = w.user_id
+    ORDER BY w.date DESC, w.time DESC, w.id, s.set_number
+'''
+
+SQL_EXPORT_USER_WORKOUTS = '''
+    SELECT w.id, w.date, w.time, w.muscle_group, w.exercise, w.user_id,
+           s.set_number, s.reps, s.weight_kg
+    FROM workouts w
+    LEFT JOIN workout_sets s ON s.workout_id = w.id
+    WHERE w.user_id = ?
+    ORDER BY w.date DESC, w.time DESC, w.id, s.set_number
+'''
+
+# Admin user view - the user, all of their sessions and all of their workouts
+SQL_ADMIN_USER = 'SELECT id, username, email, is_admin, created_at, workout_count FROM users WHERE id = ?'
+
+# Walks idx_sessions_user_date, so the rows come back in display order without a sort
+SQL_USER_SESSIONS = '''
+    SELECT id, date, start_time, end_time, duration_minutes
+    FROM sessions
+    WHERE user_id = ?
+    ORDER BY date DESC, start_time DESC
+'''
+
+SQL_USER_WORKOUTS = '''
+    SELECT id, date, time, muscle_group, exercise, session_id
+    FROM workouts
+    WHERE user_id = ?
+    ORDER BY date DESC, time DESC
+'''
+
 # User class for Flask-Login
 class User(UserMixin):
     def __init__(self, id, username, email, is_admin=False):
@@ -37,153 +197,378 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    """Load user from database for Flask-Login"""
-    conn = get_db_connection()
-    try:
-        c = conn.cursor()
-        c.execute('SELECT id, username, email, is_admin FROM users WHERE id = ?', (user_id,))
-        user_data = c.fetchone()
-        if user_data:
-            return User(user_data[0], user_data[1], user_data[2], bool(user_data[3]))
-        return None
-    finally:
-        conn.close()
+    """Load user from database for Flask-Login (reused across requests for a short while)"""
+    user = cache.get(user_cache_key(user_id))
+    if user is not None:
+        return user
+    
+    conn = get_ro_db()
+    c = conn.cursor()
+    c.execute(SQL_USER_BY_ID, (user_id,))
+    user_data = c.fetchone()
+    if user_data:
+        user = User(user_data[0], user_data[1], user_data[2], bool(user_data[3]))
+        cache.set(user_cache_key(user_id), user, timeout=USER_CACHE_TIMEOUT)
+        return user
+    return None
+
+def user_cache_key(user_id):
+    """Cache key for a loaded user (user_id may be the session's string or an int)"""
+    return f'user:{user_id}'
 
-def get_db_connection():
+def get_db_connection(readonly=False):
     """Get a database connection with proper timeout and settings"""
-    conn = sqlite3.connect('workouts.db', timeout=10.0)
-    conn.execute('PRAGMA journal_mode=WAL')  # Enable Write-Ahead Logging for better concurrency
+    # timeout doubles as the busy timeout (10s) while another connection holds the write lock
+    if readonly:
+        # Under WAL, readers never wait for the writer - and these can't write by mistake
+        conn = sqlite3.connect('file:workouts.db?mode=ro', uri=True, timeout=10.0,
+                               check_same_thread=False, cached_statements=128)
+    else:
+        conn = sqlite3.connect('workouts.db', timeout=10.0, check_same_thread=False, cached_statements=128)
+        conn.execute('PRAGMA synchronous=NORMAL')  # Safe with WAL, avoids an fsync on every commit
+        conn.execute('PRAGMA foreign_keys=ON')  # Enforce ON DELETE CASCADE
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-64000')  # 64MB page cache per connection
+    conn.execute('PRAGMA mmap_size=268435456')
     conn.row_factory = sqlite3.Row  # Enable column access by name
     return conn
 
+# Connection pools shared by all requests - one of read-write connections and one of
+# read-only connections for the pages that only read. Slots start out empty (None) and
+# are opened on first use, so at most DB_POOL_SIZE connections of each kind are ever open.
+# LIFO hands out the most recently returned connection (warm page and statement caches)
+# first, and only opens as many connections as requests ever actually overlap.
+_db_pools = {False: queue.LifoQueue(maxsize=DB_POOL_SIZE), True: queue.LifoQueue(maxsize=DB_POOL_SIZE)}
+for _pool in _db_pools.values():
+    for _ in range(DB_POOL_SIZE):
+        _pool.put(None)
+
+def acquire_conn(readonly=False):
+    """Take a connection from the pool, opening it on first use"""
+    pool = _db_pools[readonly]
+    conn = pool.get()
+    if conn is None:
+        try:
+            conn = get_db_connection(readonly)
+        except Exception:
+            pool.put(None)  # Give the empty slot back
+            raise
+        # Autocommit mode - writes open their own BEGIN IMMEDIATE transaction
+        conn.isolation_level = None
+    return conn
+
+def release_conn(conn, readonly=False):
+    """Hand a connection back to the pool"""
+    if conn.in_transaction:
+        conn.rollback()  # Never pass an unfinished transaction on to the next request
+    _db_pools[readonly].put(conn)
+
+def get_db():
+    """The current request's read-write connection - borrowed from the pool on first use
+    and shared by everything that runs during the request"""
+    if '_db' not in g:
+        g._db = acquire_conn()
+    return g._db
+
+def get_ro_db():
+    """Like get_db(), but a read-only connection for code that never writes"""
+    if '_ro_db' not in g:
+        g._ro_db = acquire_conn(readonly=True)
+    return g._ro_db
+
+@app.teardown_appcontext
+def close_db(exception):
+    """Return the request's connections to their pools"""
+    conn = g.pop('_db', None)
+    if conn is not None:
+        release_conn(conn)
+    
+    conn = g.pop('_ro_db', None)
+    if conn is not None:
+        release_conn(conn, readonly=True)
+
+def iter_rows(c, size=CSV_BATCH_SIZE):
+    """Yield a cursor's rows, pulling them in batches of size instead of all at once"""
+    while True:
+        rows = c.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+def insert_returning_id(c, sql, params):
+    """Run an INSERT ending in RETURNING_ID and return the new row's id"""
+    c.execute(sql, params)
+    if SQLITE_HAS_RETURNING:
+        (row_id,) = c.fetchone()
+        return row_id
+    return c.lastrowid
+
+def has_pending_flashes():
+    """True if flash messages are waiting to be shown (cached pages must not swallow them)"""
+    return '_flashes' in session
+
+def user_data_rev(user_id):
+    """The user's data revision (users.data_rev, bumped by triggers on every write to their
+    workouts and sessions), or None if the user no longer exists"""
+    row = get_ro_db().execute('SELECT data_rev FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row[0] if row else None
+
+def index_cache_key():
+    """Cache key for the index page: per user, per data revision and per query string.
+    The revision is read from the database, so a write made from another browser or
+    worker process is seen on the very next request."""
+    return 'index:{}:{}:{}:{}'.format(
+        current_user.id,
+        user_data_rev(current_user.id),
+        request.args.get('error', ''),
+        request.args.get('submitted', '')
+    )
+
+def admin_cache_key(**view_args):
+    """Cache key for the admin pages: per admin, per page and per revision of all users' data.
+    The user count and highest id change with every registration and deletion, and the
+    data revisions only ever go up, so any write anywhere moves the pages to a fresh key."""
+    c = get_ro_db().execute('SELECT COUNT(*), MAX(id), TOTAL(data_rev) FROM users')
+    return 'admin:{}:{}:{}'.format(current_user.id, tuple(c.fetchone()), request.path)
+
+def gzip_stream(chunks):
+    """Gzip-compress a stream of text chunks as it is produced, yielding bytes"""
+    # wbits=31 selects the gzip container. Level 1 already gets most of the size
+    # reduction on repetitive CSV, for a fraction of the default level's CPU.
+    compressor = zlib.compressobj(level=1, wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def verify_password(password_hash, password):
+    """Check a password against its stored hash - argon2, or a Werkzeug hash from older versions"""
+    if not password_hash.startswith('$argon2'):
+        return check_password_hash(password_hash, password)
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_needs_rehash(password_hash):
+    """True for legacy Werkzeug hashes and argon2 hashes made with outdated parameters"""
+    return not password_hash.startswith('$argon2') or password_hasher.check_needs_rehash(password_hash)
+
 def admin_required(f):
     """Decorator to require admin access"""
     @wraps(f)
     @login_required
     def decorated_function(*args, **kwargs):
-        if not current_user.is_admin:
+        is_admin = current_user.is_admin
+        
+        # The loaded user can come from the user cache (and another worker may have deleted
+        # or demoted them since), so changes are only allowed if the database still agrees
+        if is_admin and request.method == 'POST':
+            c = get_ro_db().execute('SELECT is_admin FROM users WHERE id = ?', (current_user.id,))
+            row = c.fetchone()
+            if not (row and row[0]):
+                cache.delete(user_cache_key(current_user.id))
+                is_admin = False
+        
+        if not is_admin:
             flash('Access denied. Admin privileges required.', 'error')
             return redirect(url_for('index'))
         return f(*args, **kwargs)
     return decorated_function
 
+USERS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        is_admin INTEGER DEFAULT 0,
+        created_at TEXT NOT NULL,
+        workout_count INTEGER NOT NULL DEFAULT 0,
+        session_count INTEGER NOT NULL DEFAULT 0,
+        data_rev INTEGER NOT NULL DEFAULT 0
+    )
+'''
+
+# users.workout_count / users.session_count follow every insert, delete and change of owner
+# (including ON DELETE CASCADE), so the stats pages read them instead of counting rows.
+# users.data_rev goes up on each of those and when a session ends - the cached pages are
+# keyed by it, so any write, from any browser or worker process, moves them to a fresh key.
+# The triggers are dropped first so databases upgraded from older versions get these bodies.
+COUNTER_TRIGGERS_SQL = ';\n'.join(
+    f'''
+    DROP TRIGGER IF EXISTS trg_{table}_count_insert;
+    CREATE TRIGGER trg_{table}_count_insert AFTER INSERT ON {table}
+    BEGIN
+        UPDATE users SET {column} = {column} + 1, data_rev = data_rev + 1 WHERE id = NEW.user_id;
+    END;
+    DROP TRIGGER IF EXISTS trg_{table}_count_delete;
+    CREATE TRIGGER trg_{table}_count_delete AFTER DELETE ON {table}
+    BEGIN
+        UPDATE users SET {column} = {column} - 1, data_rev = data_rev + 1 WHERE id = OLD.user_id;
+    END;
+    DROP TRIGGER IF EXISTS trg_{table}_count_owner;
+    CREATE TRIGGER trg_{table}_count_owner AFTER UPDATE OF user_id ON {table}
+    BEGIN
+        UPDATE users SET {column} = {column} - 1, data_rev = data_rev + 1 WHERE id = OLD.user_id;
+        UPDATE users SET {column} = {column} + 1, data_rev = data_rev + 1 WHERE id = NEW.user_id;
+    END
+'''
+    for table, column in [('workouts', 'workout_count'), ('sessions', 'session_count')]
+) + ''';
+    DROP TRIGGER IF EXISTS trg_sessions_rev_end;
+    CREATE TRIGGER trg_sessions_rev_end AFTER UPDATE OF end_time ON sessions
+    BEGIN
+        UPDATE users SET data_rev = data_rev + 1 WHERE id = NEW.user_id;
+    END
+'''
+
+# Table definitions that are also used to rebuild older tables, hence the {table} placeholder.
+# The date/time columns default to SQLite's local "now" so inserts don't have to pass them.
+WORKOUTS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        date TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d', 'now', 'localtime')),
+        time TEXT NOT NULL DEFAULT (strftime('%H:%M:%S', 'now', 'localtime')),
+        muscle_group TEXT NOT NULL,
+        exercise TEXT NOT NULL,
+        session_id INTEGER,
+        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+    )
+'''
+
+SESSIONS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        date TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d', 'now', 'localtime')),
+        start_time TEXT NOT NULL DEFAULT (strftime('%H:%M:%S', 'now', 'localtime')),
+        end_time TEXT,
+        duration_minutes REAL,
+        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+    )
+'''
+
+def table_columns(c, table):
+    """Map a table's column names to their declared DEFAULT (empty if the table doesn't exist)"""
+    c.execute(f'PRAGMA table_info({table})')
+    return {row[1]: row[4] for row in c.fetchall()}
+
+# Everything after the workouts/sessions tables. Safe to re-run on any older schema.
+SCHEMA_REST_SQL = '''
+    -- Workout sets table - stores individual sets with reps and weight
+    CREATE TABLE IF NOT EXISTS workout_sets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        workout_id INTEGER NOT NULL,
+        set_number INTEGER NOT NULL,
+        reps INTEGER NOT NULL,
+        weight_kg REAL NOT NULL,
+        FOREIGN KEY (workout_id) REFERENCES workouts (id) ON DELETE CASCADE
+    );
+    
+    -- Indexes backing the ORDER BY / JOIN paths used on every request
+    CREATE INDEX IF NOT EXISTS idx_workouts_date_time ON workouts (date DESC, time DESC);
+    -- Per-user listings (profile, admin user view, CSV export) and ON DELETE CASCADE from users
+    CREATE INDEX IF NOT EXISTS idx_workouts_user_date ON workouts (user_id, date DESC, time DESC);
+    -- (session_id, time) lets the session view walk workouts in display order, so with
+    -- idx_workout_sets_wid its ORDER BY needs no temp B-tree; it supersedes (session_id)
+    DROP INDEX IF EXISTS idx_workouts_session;
+    CREATE INDEX IF NOT EXISTS idx_workouts_session_time ON workouts (session_id, time);
+    CREATE INDEX IF NOT EXISTS idx_workout_sets_wid ON workout_sets (workout_id, set_number);
+    
+    -- Partial indexes for each user's active (end_time IS NULL) and completed sessions.
+    -- They replace the earlier partial indexes that weren't keyed by user.
+    DROP INDEX IF EXISTS idx_sessions_active;
+    DROP INDEX IF EXISTS idx_sessions_completed;
+    CREATE INDEX IF NOT EXISTS idx_sessions_user_active
+    ON sessions (user_id, date DESC, start_time DESC)
+    WHERE end_time IS NULL;
+    CREATE INDEX IF NOT EXISTS idx_sessions_user_completed
+    ON sessions (user_id, date DESC, end_time DESC)
+    WHERE end_time IS NOT NULL;
+    -- All of a user's sessions in display order (admin user view)
+    CREATE INDEX IF NOT EXISTS idx_sessions_user_date ON sessions (user_id, date DESC, start_time DESC);
+    
+    -- Recount every user's workouts and sessions, as rebuilt tables were copied without triggers
+    UPDATE users SET
+        workout_count = (SELECT COUNT(*) FROM workouts WHERE user_id = users.id),
+        session_count = (SELECT COUNT(*) FROM sessions WHERE user_id = users.id);
+        
+    -- Refresh planner statistics so the new indexes are picked up
+    ANALYZE
+'''
+
+def rebuild_table_sql(table, create_sql, columns):
+    """SQL that recreates a table from create_sql, copying the given columns of every row across"""
+    columns = ', '.join(columns)
+    return ';\n'.join([
+        create_sql.format(table=f'{table}_new'),
+        f'INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}',
+        f'DROP TABLE {table}',
+        f'ALTER TABLE {table}_new RENAME TO {table}',
+    ])
+
 def init_db():
     """Initialize the database with the required schema"""
     conn = get_db_connection()
     try:
-        c = conn.cursor()
-        
-        # Create users table
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                is_admin INTEGER DEFAULT 0,
-                created_at TEXT NOT NULL
-            )
-        ''')
+        # Write-Ahead Logging for better concurrency. The mode is stored in the database
+        # file, so setting it once here covers every connection opened later.
+        conn.execute('PRAGMA journal_mode=WAL')
         
-        # Check if workouts table exists and has old schema
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='workouts'")
-        table_exists = c.fetchone()
+        # Table rebuilds below drop and recreate tables, which must not cascade
+        conn.execute('PRAGMA foreign_keys=OFF')
+        c = conn.cursor()
         
-        if table_exists:
-            # Check if old schema exists (has sets, reps, weight_kg columns)
-            c.execute("PRAGMA table_info(workouts)")
-            columns = [row[1] for row in c.fetchall()]
+        # Nothing to do if the schema is already up to date
+        c.execute('PRAGMA user_version')
+        (user_version,) = c.fetchone()
+        if user_version >= SCHEMA_VERSION:
+            return
+        
+        # Work out what has to change, then apply the whole upgrade as one script in a
+        # single transaction - one commit, and it either fully happens or not at all
+        script = ['BEGIN IMMEDIATE', USERS_TABLE_SQL]
+        
+        # Users tables from older versions lack the workout/session counters
+        user_columns = table_columns(c, 'users')
+        if user_columns and 'workout_count' not in user_columns:
+            script.append('ALTER TABLE users ADD COLUMN workout_count INTEGER NOT NULL DEFAULT 0')
+            script.append('ALTER TABLE users ADD COLUMN session_count INTEGER NOT NULL DEFAULT 0')
+        if user_columns and 'data_rev' not in user_columns:
+            script.append('ALTER TABLE users ADD COLUMN data_rev INTEGER NOT NULL DEFAULT 0')
             
-            if 'sets' in columns or 'reps' in columns or 'weight_kg' in columns:
-                # Old schema detected - migrate to new schema
-                # Create new workouts table with correct schema
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS workouts_new (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        date TEXT NOT NULL,
-                        time TEXT NOT NULL,
-                        muscle_group TEXT NOT NULL,
-                        exercise TEXT NOT NULL
-                    )
-                ''')
-                
-                # Migrate existing data (only basic info, sets will be lost)
-                c.execute('''
-                    INSERT INTO workouts_new (id, date, time, muscle_group, exercise)
-                    SELECT id, date, time, muscle_group, exercise
-                    FROM workouts
-                ''')
-                
-                # Drop old table and rename new one
-                c.execute('DROP TABLE workouts')
-                c.execute('ALTER TABLE workouts_new RENAME TO workouts')
-        
         # Workouts table - stores basic workout info
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS workouts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                date TEXT NOT NULL,
-                time TEXT NOT NULL,
-                muscle_group TEXT NOT NULL,
-                exercise TEXT NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Add user_id column to workouts if it doesn't exist
-        c.execute("PRAGMA table_info(workouts)")
-        columns = [row[1] for row in c.fetchall()]
-        if 'user_id' not in columns:
-            try:
-                c.execute('ALTER TABLE workouts ADD COLUMN user_id INTEGER')
-            except sqlite3.OperationalError:
-                pass  # Column might already exist
+        workout_columns = table_columns(c, 'workouts')
+        if not workout_columns:
+            script.append(WORKOUTS_TABLE_SQL.format(table='workouts'))
+        elif workout_columns.keys() & {'sets', 'reps', 'weight_kg'}:
+            # Old schema detected - migrate to new schema (only basic info, sets will be lost)
+            script.append(rebuild_table_sql('workouts', WORKOUTS_TABLE_SQL, ['id', 'date', 'time', 'muscle_group', 'exercise']))
+        elif workout_columns['date'] is None:
+            # Tables from older versions lack user_id/session_id and the date/time defaults.
+            # SQLite can't add a DEFAULT to an existing column, so rebuild with the current schema.
+            script.append(rebuild_table_sql('workouts', WORKOUTS_TABLE_SQL, workout_columns))
         
         # Sessions table - tracks gym sessions
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                date TEXT NOT NULL,
-                start_time TEXT NOT NULL,
-                end_time TEXT,
-                duration_minutes REAL,
-                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Add user_id column to sessions if it doesn't exist
-        c.execute("PRAGMA table_info(sessions)")
-        columns = [row[1] for row in c.fetchall()]
-        if 'user_id' not in columns:
-            try:
-                c.execute('ALTER TABLE sessions ADD COLUMN user_id INTEGER')
-            except sqlite3.OperationalError:
-                pass  # Column might already exist
-        
-        # Add session_id to workouts table if it doesn't exist
-        c.execute("PRAGMA table_info(workouts)")
-        columns = [row[1] for row in c.fetchall()]
-        if 'session_id' not in columns:
-            try:
-                c.execute('ALTER TABLE workouts ADD COLUMN session_id INTEGER')
-            except sqlite3.OperationalError:
-                pass  # Column might already exist
-        
-        # Workout sets table - stores individual sets with reps and weight
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS workout_sets (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                workout_id INTEGER NOT NULL,
-                set_number INTEGER NOT NULL,
-                reps INTEGER NOT NULL,
-                weight_kg REAL NOT NULL,
-                FOREIGN KEY (workout_id) REFERENCES workouts (id) ON DELETE CASCADE
-            )
-        ''')
-        
-        conn.commit()
+        session_columns = table_columns(c, 'sessions')
+        if not session_columns:
+            script.append(SESSIONS_TABLE_SQL.format(table='sessions'))
+        elif session_columns['date'] is None:
+            # Same as workouts - older tables lack user_id and the date/start_time defaults
+            script.append(rebuild_table_sql('sessions', SESSIONS_TABLE_SQL, session_columns))
+        
+        script.append(SCHEMA_REST_SQL)
+        script.append(COUNTER_TRIGGERS_SQL)
+        
+        # Record the schema version so later starts can skip all of the above
+        script.append(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        script.append('COMMIT')
+        
+        # A failure leaves the transaction open; closing the connection rolls it back
+        c.executescript(';\n'.join(script))
     finally:
         conn.close()
 
@@ -198,7 +583,14 @@ def migrate_existing_data_to_admin():
         c.execute('SELECT id FROM users WHERE username = ?', ('admin',))
         admin_user = c.fetchone()
         
-        if admin_user:
+        # Read first - the UPDATEs would take the write lock at every start even with nothing to do
+        c.execute('''
+            SELECT EXISTS (SELECT 1 FROM workouts WHERE user_id IS NULL)
+                OR EXISTS (SELECT 1 FROM sessions WHERE user_id IS NULL)
+        ''')
+        (has_unowned_rows,) = c.fetchone()
+        
+        if admin_user and has_unowned_rows:
             admin_id = admin_user[0]
             
             # Update workouts without user_id
@@ -241,7 +633,7 @@ def register():
             flash('Password must be at least 6 characters long.', 'error')
             return render_template('register.html')
         
-        conn = get_db_connection()
+        conn = get_db()
         try:
             c = conn.cursor()
             
@@ -254,7 +646,7 @@ def register():
                 return render_template('register.html')
             
             # Create new user
-            password_hash = generate_password_hash(password)
+            password_hash = password_hasher.hash(password)
             created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
             c.execute('''
@@ -268,8 +660,6 @@ def register():
         except sqlite3.IntegrityError:
             flash('Username or email already exists.', 'error')
             return render_template('register.html')
-        finally:
-            conn.close()
     
     return render_template('register.html')
 
@@ -287,22 +677,23 @@ def login():
             flash('Please enter both username and password.', 'error')
             return render_template('login.html')
         
-        conn = get_db_connection()
-        try:
-            c = conn.cursor()
-            c.execute('SELECT id, username, email, password_hash, is_admin FROM users WHERE username = ?', (username,))
-            user_data = c.fetchone()
-            
-            if user_data and check_password_hash(user_data[3], password):
-                user = User(user_data[0], user_data[1], user_data[2], bool(user_data[4]))
-                login_user(user)
-                next_page = request.args.get('next')
-                flash(f'Welcome back, {username}!', 'success')
-                return redirect(next_page) if next_page else redirect(url_for('index'))
-            else:
-                flash('Invalid username or password.', 'error')
-        finally:
-            conn.close()
+        conn = get_db()
+        c = conn.cursor()
+        c.execute(SQL_USER_BY_USERNAME, (username,))
+        user_data = c.fetchone()
+        
+        if user_data and verify_password(user_data[3], password):
+            # Upgrade legacy hashes now that the plain password is at hand
+            if password_needs_rehash(user_data[3]):
+                c.execute('UPDATE users SET password_hash = ? WHERE id = ?',
+                          (password_hasher.hash(password), user_data[0]))
+            user = User(user_data[0], user_data[1], user_data[2], bool(user_data[4]))
+            login_user(user)
+            next_page = request.args.get('next')
+            flash(f'Welcome back, {username}!', 'success')
+            return redirect(next_page) if next_page else redirect(url_for('index'))
+        else:
+            flash('Invalid username or password.', 'error')
     
     return render_template('login.html')
 
@@ -317,131 +708,86 @@ def logout():
 # Main Application Routes
 @app.route('/')
 @login_required
+@cache.cached(timeout=30, make_cache_key=index_cache_key, unless=has_pending_flashes,
+              response_filter=lambda rv: isinstance(rv, str))
 def index():
     """Main page displaying the form and last session"""
-    conn = get_db_connection()
-    try:
-        c = conn.cursor()
-        
-        # Check if there's an active session for current user
-        c.execute('''
-            SELECT id, date, start_time
-            FROM sessions
-            WHERE user_id = ? AND end_time IS NULL
-            ORDER BY date DESC, start_time DESC
-            LIMIT 1
-        ''', (current_user.id,))
-        active_session_row = c.fetchone()
-        active_session = None
-        if active_session_row:
-            active_session = {
-                'id': active_session_row['id'],
-                'date': active_session_row['date'],
-                'start_time': active_session_row['start_time']
-            }
-        
-        # Get last completed session for current user
-        c.execute('''
-            SELECT id, date, start_time, end_time, duration_minutes
-            FROM sessions
-            WHERE user_id = ? AND end_time IS NOT NULL
-            ORDER BY date DESC, end_time DESC
-            LIMIT 1
-        ''', (current_user.id,))
-        last_session_row = c.fetchone()
-        
-        session_data = None
-        session_workouts = []
-        
-        if last_session_row:
-            session_id = last_session_row['id']
-            # Get all workouts for this session (only current user's workouts)
-            c.execute('''
-                SELECT id, date, time, muscle_group, exercise
-                FROM workouts
-                WHERE session_id = ? AND user_id = ?
-                ORDER BY time
-            ''', (session_id, current_user.id))
-            workouts = c.fetchall()
-            
-            # Get sets for each workout
-            for workout in workouts:
-                workout_id = workout['id']
-                c.execute('''
-                    SELECT set_number, reps, weight_kg
-                    FROM workout_sets
-                    WHERE workout_id = ?
-                    ORDER BY set_number
-                ''', (workout_id,))
-                sets = c.fetchall()
-                session_workouts.append({
-                    'id': workout['id'],
-                    'date': workout['date'],
-                    'time': workout['time'],
-                    'muscle_group': workout['muscle_group'],
-                    'exercise': workout['exercise'],
-                    'sets': [(s['set_number'], s['reps'], s['weight_kg']) for s in sets]
-                })
-            
-            session_data = {
-                'id': last_session_row['id'],
-                'date': last_session_row['date'],
-                'start_time': last_session_row['start_time'],
-                'end_time': last_session_row['end_time'],
-                'duration_minutes': last_session_row['duration_minutes']
-            }
-        
-        # Check for error messages
-        error = request.args.get('error')
-        if error and active_session:
-            # Clear stale error messages when a session is now active
-            return redirect(url_for('index'))
+    conn = get_ro_db()
+    c = conn.cursor()
+    
+    # Check if there's an active session for current user
+    c.execute(SQL_ACTIVE_SESSION, (current_user.id,))
+    # sqlite3.Row objects go to the template as-is - Jinja reads their columns by name
+    active_session = c.fetchone()
+    
+    # Get last completed session for current user
+    c.execute(SQL_LAST_COMPLETED_SESSION, (current_user.id,))
+    last_session = c.fetchone()
+    
+    session_workouts = []
+    
+    if last_session:
+        session_id = last_session['id']
+        # Get all workouts for this session together with their sets in one query
+        # (only current user's workouts)
+        c.execute(SQL_SESSION_WORKOUTS_WITH_SETS, (session_id, current_user.id))
+        
+        # Rows arrive ordered by workout, so each workout's sets are consecutive
+        # and can be grouped straight off the cursor
+        for _, rows in groupby(c, key=itemgetter('id')):
+            rows = list(rows)
+            first = rows[0]
+            session_workouts.append({
+                'id': first['id'],
+                'date': first['date'],
+                'time': first['time'],
+                'muscle_group': first['muscle_group'],
+                'exercise': first['exercise'],
+                # A workout without sets comes back as one row with NULL set columns
+                'sets': [(row['set_number'], row['reps'], row['weight_kg'])
+                         for row in rows if row['set_number'] is not None]
+            })
+    
+    # Check for error messages
+    error = request.args.get('error')
+    if error and active_session:
+        # Clear stale error messages when a session is now active
+        return redirect(url_for('index'))
 
-        error_message = None
-        if error == 'no_session':
-            error_message = 'Please start a gym session before logging workouts.'
-        
-        return render_template('index.html', 
-                             active_session=active_session,
-                             last_session=session_data, 
-                             session_workouts=session_workouts,
-                             exercises=EXERCISES,
-                             error_message=error_message)
-    finally:
-        conn.close()
+    error_message = None
+    if error == 'no_session':
+        error_message = 'Please start a gym session before logging workouts.'
+    
+    return render_template('index.html', 
+                         active_session=active_session,
+                         last_session=last_session,
+                         session_workouts=session_workouts,
+                         exercises=EXERCISES,
+                         error_message=error_message)
 
 @app.route('/start_session', methods=['POST'])
 @login_required
 def start_session():
     """Start a new gym session"""
-    conn = get_db_connection()
+    conn = get_db()
     try:
         c = conn.cursor()
         
+        # Take the write lock up front instead of upgrading a read transaction later
+        c.execute('BEGIN IMMEDIATE')
+        
         # Check if there's already an active session for current user
-        c.execute('''
-            SELECT id FROM sessions
-            WHERE user_id = ? AND end_time IS NULL
-            ORDER BY date DESC, start_time DESC
-            LIMIT 1
-        ''', (current_user.id,))
-        active_session = c.fetchone()
-        
-        if active_session:
+        row = c.execute(SQL_ACTIVE_SESSION_ID, (current_user.id,)).fetchone()
+        active_id = row[0] if row else None
+        
+        if active_id:
             # Session already active, just redirect
+            conn.rollback()
             flash('Session already active.', 'info')
             return redirect(url_for('index'))
         
-        # Get current date and time
-        now = datetime.now()
-        date = now.strftime('%Y-%m-%d')
-        start_time = now.strftime('%H:%M:%S')
-        
-        # Create new session with user_id
-        c.execute('''
-            INSERT INTO sessions (user_id, date, start_time)
-            VALUES (?, ?, ?)
-        ''', (current_user.id, date, start_time))
+        # Create new session with user_id (date and start time are set by SQLite)
+        insert_returning_id(c, SQL_INSERT_SESSION, (current_user.id,))
         
         conn.commit()
         flash('Session started!', 'success')
@@ -450,122 +796,81 @@ def start_session():
         conn.rollback()
         flash('Error starting session.', 'error')
         return redirect(url_for('index'))
-    finally:
-        conn.close()
 
 @app.route('/end_session', methods=['POST'])
 @login_required
 def end_session():
     """End the current gym session and calculate duration"""
-    conn = get_db_connection()
+    conn = get_db()
     try:
         c = conn.cursor()
         
-        # Get active session for current user
-        c.execute('''
-            SELECT id, date, start_time
-            FROM sessions
-            WHERE user_id = ? AND end_time IS NULL
-            ORDER BY date DESC, start_time DESC
-            LIMIT 1
-        ''', (current_user.id,))
-        active_session = c.fetchone()
-        
-        if not active_session:
-            return redirect(url_for('index'))
-        
-        session_id = active_session['id']
-        session_date = active_session['date']
-        start_time_str = active_session['start_time']
-        
-        # Get current time
-        now = datetime.now()
-        end_date = now.strftime('%Y-%m-%d')
-        end_time = now.strftime('%H:%M:%S')
+        # Stamp the end time on the active session and compute the duration in minutes,
+        # all in SQLite. A single statement is atomic, so no explicit transaction is needed.
+        c.execute(SQL_END_ACTIVE_SESSION, (current_user.id,))
         
-        # Calculate duration
-        start_datetime = datetime.strptime(f"{session_date} {start_time_str}", "%Y-%m-%d %H:%M:%S")
-        end_datetime = datetime.strptime(f"{end_date} {end_time}", "%Y-%m-%d %H:%M:%S")
-        
-        # Calculate duration in minutes
-        duration = (end_datetime - start_datetime).total_seconds() / 60
-        
-        # Update session with end time and duration
-        c.execute('''
-            UPDATE sessions
-            SET end_time = ?, duration_minutes = ?
-            WHERE id = ? AND user_id = ?
-        ''', (end_time, duration, session_id, current_user.id))
+        if c.rowcount == 0:
+            # No active session for current user
+            return redirect(url_for('index'))
         
-        conn.commit()
         flash('Session ended!', 'success')
         return redirect(url_for('index'))
     except Exception as e:
         conn.rollback()
         flash('Error ending session.', 'error')
         return redirect(url_for('index'))
-    finally:
-        conn.close()
 
 @app.route('/submit', methods=['POST'])
 @login_required
 def submit():
     """Handle form submission and save workout to database"""
-    conn = get_db_connection()
+    conn = get_db()
     try:
         c = conn.cursor()
         
-        # Get active session for current user - REQUIRED for workout submission
-        c.execute('''
-            SELECT id FROM sessions
-            WHERE user_id = ? AND end_time IS NULL
-            ORDER BY date DESC, start_time DESC
-            LIMIT 1
-        ''', (current_user.id,))
-        active_session = c.fetchone()
-        
-        if not active_session:
-            # No active session - redirect back with error message
-            return redirect(url_for('index', error='no_session'))
-        
-        session_id = active_session['id']
-        
-        # Get current date and time
-        now = datetime.now()
-        date = now.strftime('%Y-%m-%d')
-        time = now.strftime('%H:%M:%S')
-        
         # Get form data
         muscle_group = request.form.get('muscle_group')
         exercise = request.form.get('exercise')
         
-        # Insert workout into database with session_id and user_id
-        c.execute('''
-            INSERT INTO workouts (user_id, date, time, muscle_group, exercise, session_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (current_user.id, date, time, muscle_group, exercise, session_id))
-        
-        workout_id = c.lastrowid
-        
-        # Get all sets from form (they come as set_1_reps, set_1_weight, set_2_reps, etc.)
-        set_number = 1
-        while True:
-            reps_key = f'set_{set_number}_reps'
-            weight_key = f'set_{set_number}_weight'
-            
-            if reps_key not in request.form or weight_key not in request.form:
-                break
+        # Get all sets from form (they come as set_1_reps, set_1_weight, set_2_reps, etc.),
+        # grouping the fields by set number in a single pass
+        form_sets = {}
+        for key, value in request.form.items():
+            match = _SET_RE.match(key)
+            if match:
+                form_sets.setdefault(int(match.group(1)), {})[match.group(2)] = value
+        
+        # Parse every set before taking the write lock, so it is only held for the inserts
+        parsed_sets = []
+        for set_number, fields in sorted(form_sets.items()):
+            if 'reps' not in fields or 'weight' not in fields:
+                continue  # Incomplete set
             
-            reps = int(request.form.get(reps_key, 0))
-            weight_kg = float(request.form.get(weight_key, 0))
+            reps = int(fields['reps'])
+            weight_kg = float(fields['weight'])
             
             if reps > 0:  # Only insert if reps > 0
-                c.execute('''
-                    INSERT INTO workout_sets (workout_id, set_number, reps, weight_kg)
-                    VALUES (?, ?, ?, ?)
-                ''', (workout_id, set_number, reps, weight_kg))
-            
-            set_number += 1
+                parsed_sets.append((set_number, reps, weight_kg))
+        
+        # Take the write lock up front instead of upgrading a read transaction later
+        c.execute('BEGIN IMMEDIATE')
+        
+        # An active session is REQUIRED for workout submission. It is looked up inside the
+        # transaction, so it can't be ended (from another browser) before the workout is saved.
+        row = c.execute(SQL_ACTIVE_SESSION_ID, (current_user.id,)).fetchone()
+        if not row:
+            # No active session - redirect back with error message
+            conn.rollback()
+            return redirect(url_for('index', error='no_session'))
+        
+        session_id = row[0]
+        
+        # Insert workout into database with session_id and user_id (date and time are set by SQLite)
+        workout_id = insert_returning_id(c, SQL_INSERT_WORKOUT,
+                                         (current_user.id, muscle_group, exercise, session_id))
+        
+        # Insert all sets in one batch
+        c.executemany(SQL_INSERT_SET, [(workout_id,) + s for s in parsed_sets])
         
         conn.commit()
         flash('Workout logged successfully!', 'success')
@@ -574,264 +879,241 @@ def submit():
         conn.rollback()
         flash('Error logging workout.', 'error')
         return redirect(url_for('index'))
-    finally:
-        conn.close()
 
 @app.route('/exercises/<muscle_group>')
 @login_required
 def get_exercises(muscle_group):
     """API endpoint to get exercises for a specific muscle group"""
-    exercises = EXERCISES.get(muscle_group, [])
-    return jsonify({'exercises': exercises})
+    response = Response(
+        _EXERCISE_JSON.get(muscle_group, _EMPTY_EXERCISE_JSON),
+        mimetype='application/json',
+        headers={'Cache-Control': 'public, max-age=86400'}
+    )
+    # Revalidation after max-age gets an empty 304 when the list hasn't changed
+    response.set_etag(_EXERCISE_ETAGS.get(muscle_group, _EMPTY_EXERCISE_ETAG))
+    return response.make_conditional(request)
 
 @app.route('/download_csv')
 @login_required
 def download_csv():
-    """Download workouts as CSV (user's own data, or all data if admin)"""
-    conn = get_db_connection()
-    try:
-        c = conn.cursor()
-        
-        # Admin can see all workouts, regular users see only their own
-        if current_user.is_admin:
-            c.execute('''
-                SELECT id, date, time, muscle_group, exercise, user_id
-                FROM workouts
-                ORDER BY date DESC, time DESC
-            ''')
+    """Stream workouts as CSV (user's own data, or all data if admin)"""
+    is_admin = current_user.is_admin
+    user_id = current_user.id
+    
+    def generate():
+        """Yield the CSV one row at a time straight off the database cursor"""
+        # The client sets the pace of the stream, so it gets its own read-only connection
+        # rather than holding one of the pooled connections the other requests need
+        conn = get_db_connection(readonly=True)
+        try:
+            yield from generate_rows(conn.cursor())
+        finally:
+            conn.close()
+    
+    def generate_rows(c):
+        # Admin can see all workouts, regular users see only their own.
+        # Sets (and for admins, usernames) are joined in so each workout doesn't need its own query.
+        if is_admin:
+            c.execute(SQL_EXPORT_ALL_WORKOUTS)
         else:
-            c.execute('''
-                SELECT id, date, time, muscle_group, exercise, user_id
-                FROM workouts
-                WHERE user_id = ?
-                ORDER BY date DESC, time DESC
-            ''', (current_user.id,))
-        
-        workouts = c.fetchall()
+            c.execute(SQL_EXPORT_USER_WORKOUTS, (user_id,))
+            
+        # Small reusable buffer - each batch of rows is written, yielded and cleared
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
         
-        # Create CSV in memory
-        output = io.StringIO()
-        writer = csv.writer(output)
+        def flush():
+            data = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return data
         
         # Add user column if admin
-        if current_user.is_admin:
+        if is_admin:
             writer.writerow(['User', 'Date', 'Time', 'Muscle Group', 'Exercise', 'Set Number', 'Reps', 'Weight (kg)'])
         else:
             writer.writerow(['Date', 'Time', 'Muscle Group', 'Exercise', 'Set Number', 'Reps', 'Weight (kg)'])
+        yield flush()
         
-        # Write each workout with all its sets
-        for workout in workouts:
-            workout_id = workout['id']
-            date = workout['date']
-            time = workout['time']
-            muscle_group = workout['muscle_group']
-            exercise = workout['exercise']
-            user_id = workout['user_id'] if current_user.is_admin else None
-            
-            # Get username if admin
-            username = None
-            if current_user.is_admin and user_id:
-                c.execute('SELECT username FROM users WHERE id = ?', (user_id,))
-                user_data = c.fetchone()
-                username = user_data['username'] if user_data else 'Unknown'
-            
-            # Get all sets for this workout
-            c.execute('''
-                SELECT set_number, reps, weight_kg
-                FROM workout_sets
-                WHERE workout_id = ?
-                ORDER BY set_number
-            ''', (workout_id,))
-            sets = c.fetchall()
+        # Write one row per set (workouts without sets get a single row with empty set columns).
+        # Rows come off the cursor in fixed-size batches, so memory stays flat for any export size.
+        while True:
+            rows = c.fetchmany(CSV_BATCH_SIZE)
+            if not rows:
+                break
             
-            if sets:
-                for set_data in sets:
-                    if current_user.is_admin:
-                        writer.writerow([username, date, time, muscle_group, exercise, set_data['set_number'], set_data['reps'], set_data['weight_kg']])
-                    else:
-                        writer.writerow([date, time, muscle_group, exercise, set_data['set_number'], set_data['reps'], set_data['weight_kg']])
-            else:
-                # Write at least one row even if no sets
-                if current_user.is_admin:
-                    writer.writerow([username, date, time, muscle_group, exercise, '', '', ''])
+            for row in rows:
+                if row['set_number'] is not None:
+                    set_columns = [row['set_number'], row['reps'], row['weight_kg']]
                 else:
-                    writer.writerow([date, time, muscle_group, exercise, '', '', ''])
-        
-        # Create BytesIO object for Flask
-        mem = io.BytesIO()
-        mem.write(output.getvalue().encode('utf-8'))
-        mem.seek(0)
-        output.close()
-        
-        filename = 'workouts.csv' if not current_user.is_admin else 'all_workouts.csv'
-        return send_file(
-            mem,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=filename
-        )
-    finally:
-        conn.close()
+                    set_columns = ['', '', '']
+                
+                if is_admin:
+                    # Workouts pointing at a user that no longer exists are labelled 'Unknown'
+                    username = row['username']
+                    if username is None and row['user_id']:
+                        username = 'Unknown'
+                    writer.writerow([username, row['date'], row['time'], row['muscle_group'], row['exercise']] + set_columns)
+                else:
+                    writer.writerow([row['date'], row['time'], row['muscle_group'], row['exercise']] + set_columns)
+            yield flush()
+    
+    filename = 'workouts.csv' if not is_admin else 'all_workouts.csv'
+    headers = {'Content-Disposition': f'attachment; filename={filename}', 'Vary': 'Accept-Encoding'}
+
+    # CSV compresses very well - gzip it on the fly for clients that accept it
+    body = generate()
+    if request.accept_encodings.quality('gzip') > 0:
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+
+    # Not wrapped in stream_with_context - the request's pooled connections go back
+    # to the pools as soon as the response is returned, not when the stream ends
+    return Response(
+        body,
+        mimetype='text/csv',
+        headers=headers
+    )
 
 # User Profile Route
 @app.route('/profile')
 @login_required
 def profile():
     """User profile page showing their stats"""
-    conn = get_db_connection()
-    try:
-        c = conn.cursor()
-        
-        # Get user stats
-        c.execute('SELECT COUNT(*) FROM workouts WHERE user_id = ?', (current_user.id,))
-        total_workouts = c.fetchone()[0]
-        
-        c.execute('SELECT COUNT(*) FROM sessions WHERE user_id = ?', (current_user.id,))
-        total_sessions = c.fetchone()[0]
-        
-        c.execute('''
-            SELECT COUNT(DISTINCT date) FROM workouts WHERE user_id = ?
-        ''', (current_user.id,))
-        workout_days = c.fetchone()[0]
-        
-        # Get workouts by muscle group
-        c.execute('''
-            SELECT muscle_group, COUNT(*) as count
-            FROM workouts
-            WHERE user_id = ?
-            GROUP BY muscle_group
-            ORDER BY count DESC
-        ''', (current_user.id,))
-        workouts_by_group = [(row['muscle_group'], row['count']) for row in c.fetchall()]
-        
-        # Get recent workouts (last 10)
-        c.execute('''
-            SELECT date, time, muscle_group, exercise
-            FROM workouts
-            WHERE user_id = ?
-            ORDER BY date DESC, time DESC
-            LIMIT 10
-        ''', (current_user.id,))
-        recent_workouts = [(row['date'], row['time'], row['muscle_group'], row['exercise']) for row in c.fetchall()]
-        
-        return render_template('user_profile.html',
-                             total_workouts=total_workouts,
-                             total_sessions=total_sessions,
-                             workout_days=workout_days,
-                             workouts_by_group=workouts_by_group,
-                             recent_workouts=recent_workouts)
-    finally:
-        conn.close()
+    conn = get_ro_db()
+    c = conn.cursor()
+    
+    # Get user stats in one statement - the totals are the trigger-maintained counters and
+    # the distinct days walk idx_workouts_user_date
+    c.execute('''
+        SELECT workout_count, session_count,
+               (SELECT COUNT(DISTINCT date) FROM workouts WHERE user_id = :user_id)
+        FROM users
+        WHERE id = :user_id
+    ''', {'user_id': current_user.id})
+    stats = c.fetchone()
+    
+    if stats is None:
+        # The account was deleted - another worker may still have the user cached for a while
+        logout_user()
+        flash('Your account no longer exists.', 'error')
+        return redirect(url_for('login'))
+    
+    total_workouts, total_sessions, workout_days = stats
+
+    # Get workouts by muscle group
+    c.execute('''
+        SELECT muscle_group, COUNT(*) as count
+        FROM workouts
+        WHERE user_id = ?
+        GROUP BY muscle_group
+        ORDER BY count DESC
+    ''', (current_user.id,))
+    # Rows go to the template as-is - they index like the tuples it expects. A list rather
+    # than the cursor itself, since the template's {% if %} needs to see an empty result.
+    workouts_by_group = c.fetchall()
+
+    # Get recent workouts (last 10)
+    c.execute('''
+        SELECT date, time, muscle_group, exercise
+        FROM workouts
+        WHERE user_id = ?
+        ORDER BY date DESC, time DESC
+        LIMIT 10
+    ''', (current_user.id,))
+    recent_workouts = c.fetchall()
+    
+    return render_template('user_profile.html',
+                         total_workouts=total_workouts,
+                         total_sessions=total_sessions,
+                         workout_days=workout_days,
+                         workouts_by_group=workouts_by_group,
+                         recent_workouts=recent_workouts)
 
 # Admin Routes
 @app.route('/admin')
 @admin_required
+@cache.cached(timeout=30, make_cache_key=admin_cache_key, unless=has_pending_flashes,
+              response_filter=lambda rv: isinstance(rv, str))
 def admin_dashboard():
     """Admin dashboard with statistics"""
-    conn = get_db_connection()
-    try:
-        c = conn.cursor()
-        
-        # Total users
-        c.execute('SELECT COUNT(*) FROM users')
-        total_users = c.fetchone()[0]
-        
-        # Total workouts (all users)
-        c.execute('SELECT COUNT(*) FROM workouts')
-        total_workouts = c.fetchone()[0]
-        
-        # Most active users
-        c.execute('''
-            SELECT u.username, COUNT(w.id) as workout_count
-            FROM users u
-            LEFT JOIN workouts w ON u.id = w.user_id
-            GROUP BY u.id, u.username
-            ORDER BY workout_count DESC
-            LIMIT 10
-        ''')
-        most_active_users = [(row['username'], row['workout_count']) for row in c.fetchall()]
-        
-        # Workouts per day (last 30 days, all users)
-        thirty_days_ago = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        c.execute('''
-            SELECT date, COUNT(*) as workout_count
-            FROM workouts
-            WHERE date >= ?
-            GROUP BY date
-            ORDER BY date DESC
-        ''', (thirty_days_ago,))
-        workouts_per_day = [(row['date'], row['workout_count']) for row in c.fetchall()]
-        
-        # Get all users list
-        c.execute('''
-            SELECT id, username, email, is_admin, created_at,
-                   (SELECT COUNT(*) FROM workouts WHERE user_id = users.id) as workout_count
-            FROM users
-            ORDER BY created_at DESC
-        ''')
-        all_users = [(row['id'], row['username'], row['email'], row['is_admin'], row['created_at'], row['workout_count']) for row in c.fetchall()]
-        
-        return render_template('admin_dashboard.html',
-                             total_users=total_users,
-                             total_workouts=total_workouts,
-                             most_active_users=most_active_users,
-                             workouts_per_day=workouts_per_day,
-                             all_users=all_users)
-    finally:
-        conn.close()
+    conn = get_ro_db()
+    c = conn.cursor()
+    
+    # Total users and total workouts (all users) in one round-trip
+    c.execute('SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM workouts)')
+    total_users, total_workouts = c.fetchone()
+    
+    # Workouts per day (last 30 days, all users)
+    thirty_days_ago = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+    c.execute('''
+        SELECT date, COUNT(*) as workout_count
+        FROM workouts
+        WHERE date >= ?
+        GROUP BY date
+        ORDER BY date DESC
+    ''', (thirty_days_ago,))
+    # Rows go to the template as-is - they index like the tuples it expects
+    workouts_per_day = c.fetchall()
+    
+    # Get all users list with their workout counts (trigger-maintained, no pass over workouts)
+    c.execute('''
+        SELECT id, username, email, is_admin, created_at, workout_count
+        FROM users
+        ORDER BY created_at DESC
+    ''')
+    all_users = c.fetchall()
+    
+    # Most active users - taken from the counts above rather than grouping workouts again
+    most_active_users = [(user[1], user[5]) for user in sorted(all_users, key=lambda user: user[5], reverse=True)[:10]]
+
+    return render_template('admin_dashboard.html',
+                         total_users=total_users,
+                         total_workouts=total_workouts,
+                         most_active_users=most_active_users,
+                         workouts_per_day=workouts_per_day,
+                         all_users=all_users)
 
 @app.route('/admin/user/<int:user_id>')
 @admin_required
+@cache.cached(timeout=30, make_cache_key=admin_cache_key, unless=has_pending_flashes,
+              response_filter=lambda rv: isinstance(rv, str))
 def admin_view_user(user_id):
     """Admin view of a specific user's workout data"""
-    conn = get_db_connection()
-    try:
-        c = conn.cursor()
-        
-        # Get user info
-        c.execute('SELECT id, username, email, is_admin, created_at FROM users WHERE id = ?', (user_id,))
-        user_row = c.fetchone()
-        
-        if not user_row:
-            flash('User not found.', 'error')
-            return redirect(url_for('admin_dashboard'))
-        
-        user_data = (user_row['id'], user_row['username'], user_row['email'], user_row['is_admin'], user_row['created_at'])
-        
-        # Get user's workouts
-        c.execute('''
-            SELECT w.id, w.date, w.time, w.muscle_group, w.exercise, s.start_time, s.end_time
-            FROM workouts w
-            LEFT JOIN sessions s ON w.session_id = s.id
-            WHERE w.user_id = ?
-            ORDER BY w.date DESC, w.time DESC
-        ''', (user_id,))
-        user_workouts = [(row['id'], row['date'], row['time'], row['muscle_group'], row['exercise'], row['start_time'], row['end_time']) for row in c.fetchall()]
-        
-        # Get user's sessions
-        c.execute('''
-            SELECT id, date, start_time, end_time, duration_minutes
-            FROM sessions
-            WHERE user_id = ?
-            ORDER BY date DESC, start_time DESC
-        ''', (user_id,))
-        user_sessions = [(row['id'], row['date'], row['start_time'], row['end_time'], row['duration_minutes']) for row in c.fetchall()]
-        
-        # Get stats
-        c.execute('SELECT COUNT(*) FROM workouts WHERE user_id = ?', (user_id,))
-        total_workouts = c.fetchone()[0]
-        
-        c.execute('SELECT COUNT(*) FROM sessions WHERE user_id = ?', (user_id,))
-        total_sessions = c.fetchone()[0]
-        
-        return render_template('admin_user_view.html',
-                             user_data=user_data,
-                             user_workouts=user_workouts,
-                             user_sessions=user_sessions,
-                             total_workouts=total_workouts,
-                             total_sessions=total_sessions)
-    finally:
-        conn.close()
+    conn = get_ro_db()
+    c = conn.cursor()
+    
+    # Get user info
+    c.execute(SQL_ADMIN_USER, (user_id,))
+    user_row = c.fetchone()
+    
+    if not user_row:
+        flash('User not found.', 'error')
+        return redirect(url_for('admin_dashboard'))
+    
+    # Get user's sessions
+    c.execute(SQL_USER_SESSIONS, (user_id,))
+    user_sessions = c.fetchall()
+    
+    # Get user's workouts. Their sessions were all fetched above, so the template looks
+    # each one up by id instead of the query repeating session times on every workout row.
+    # The workouts are read off the cursor in batches while the template renders them,
+    # rather than all being held in a list first.
+    c.execute(SQL_USER_WORKOUTS, (user_id,))
+    user_workouts = iter_rows(c)
+    sessions_by_id = {s['id']: s for s in user_sessions}
+    
+    # Get stats - the workout total is the user's counter, the sessions were all fetched above
+    total_workouts = user_row['workout_count']
+    total_sessions = len(user_sessions)
+    
+    return render_template('admin_user_view.html',
+                         user_data=user_row,
+                         user_workouts=user_workouts,
+                         user_sessions=user_sessions,
+                         sessions_by_id=sessions_by_id,
+                         total_workouts=total_workouts,
+                         total_sessions=total_sessions)
 
 @app.route('/admin/delete_user/<int:user_id>', methods=['POST'])
 @admin_required
@@ -841,33 +1123,74 @@ def admin_delete_user(user_id):
         flash('You cannot delete your own account.', 'error')
         return redirect(url_for('admin_dashboard'))
     
-    conn = get_db_connection()
+    conn = get_db()
     try:
         c = conn.cursor()
         
-        # Check if user exists
-        c.execute('SELECT username FROM users WHERE id = ?', (user_id,))
-        user_data = c.fetchone()
+        # Delete user (CASCADE will delete their workouts and sessions). With RETURNING the
+        # same statement reports the username, and no row back means the user doesn't exist.
+        # The statements also exclude the admin's own id, backing up the check above.
+        if SQLITE_HAS_RETURNING:
+            c.execute('DELETE FROM users WHERE id = ? AND id != ? RETURNING username', (user_id, current_user.id))
+            user_data = c.fetchone()
+        else:
+            c.execute('SELECT username FROM users WHERE id = ? AND id != ?', (user_id, current_user.id))
+            user_data = c.fetchone()
+            if user_data:
+                c.execute('DELETE FROM users WHERE id = ? AND id != ?', (user_id, current_user.id))
         
         if not user_data:
             flash('User not found.', 'error')
             return redirect(url_for('admin_dashboard'))
         
-        # Delete user (CASCADE will delete their workouts and sessions)
-        c.execute('DELETE FROM users WHERE id = ?', (user_id,))
         conn.commit()
-        
+        cache.delete(user_cache_key(user_id))
+
         flash(f'User {user_data[0]} has been deleted.', 'success')
         return redirect(url_for('admin_dashboard'))
     except Exception as e:
         conn.rollback()
         flash('Error deleting user.', 'error')
         return redirect(url_for('admin_dashboard'))
-    finally:
-        conn.close()
+
+@app.route('/admin/delete_users', methods=['POST'])
+@admin_required
+def admin_delete_users():
+    """Admin delete several selected users (but not themselves) in one transaction"""
+    user_ids = [int(i) for i in request.form.getlist('user_ids') if i.isdecimal()]
+    user_ids = [i for i in dict.fromkeys(user_ids) if i != current_user.id]
+    
+    if not user_ids:
+        flash('No users selected.', 'error')
+        return redirect(url_for('admin_dashboard'))
+    
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        
+        # Keep only the selected users that still exist
+        placeholders = ','.join('?' * len(user_ids))
+        c.execute(f'SELECT id, username FROM users WHERE id IN ({placeholders})', user_ids)
+        users = c.fetchall()
+        
+        # Delete them all in the same transaction (CASCADE will delete their workouts and sessions)
+        c.executemany('DELETE FROM users WHERE id = ?', [(user['id'],) for user in users])
+        conn.commit()
+        for user in users:
+            cache.delete(user_cache_key(user['id']))
+        
+        flash(f'{len(users)} user(s) deleted.', 'success')
+        return redirect(url_for('admin_dashboard'))
+    except Exception as e:
+        conn.rollback()
+        flash('Error deleting users.', 'error')
+        return redirect(url_for('admin_dashboard'))
 
 if __name__ == '__main__':
     init_db()
     # Run migration after initializing database (only if admin exists)
     migrate_existing_data_to_admin()
-    app.run(debug=True)
+    # Development server only - production runs under a WSGI server (see README).
+    # Each request thread borrows its own pooled connection, so serving concurrently is safe.
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', threaded=True)
@@ -3,13 +3,19 @@ Script to create admin user for Workout Tracker
 Run this script to create the admin account with a password you choose.
 """
 import sqlite3
-from werkzeug.security import generate_password_hash
+from argon2 import PasswordHasher
 from datetime import datetime
 import getpass
 
+# Same (default) Argon2id parameters as app.py, so the app never needs to rehash this password
+password_hasher = PasswordHasher()
+
 def create_admin():
     """Create admin user in the database"""
-    conn = sqlite3.connect('workouts.db')
+    # The database is already in WAL mode (set by app.py's init_db), so wait out a running
+    # app's writes instead of failing, and skip the extra fsync per commit like the app does
+    conn = sqlite3.connect('workouts.db', timeout=10.0)
+    conn.execute('PRAGMA synchronous=NORMAL')
     try:
         c = conn.cursor()
         
@@ -30,7 +36,7 @@ def create_admin():
                 print("Password must be at least 6 characters long.")
                 return
             
-            password_hash = generate_password_hash(password)
+            password_hash = password_hasher.hash(password)
             c.execute('UPDATE users SET password_hash = ? WHERE username = ?', (password_hash, 'admin'))
             conn.commit()
             print("Admin password updated successfully!")
@@ -44,18 +50,17 @@ def create_admin():
             print("Password must be at least 6 characters long.")
             return
         
-        password_hash = generate_password_hash(password)
+        password_hash = password_hasher.hash(password)
         created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
         c.execute('''
             INSERT INTO users (username, email, password_hash, is_admin, created_at)
             VALUES (?, ?, ?, 1, ?)
         ''', ('admin', 'admin@workouttracker.com', password_hash, created_at))
-        
-        conn.commit()
         admin_id = c.lastrowid
         
-        # Migrate existing workouts and sessions to admin
+        # Migrate existing workouts and sessions to admin in the same transaction,
+        # so the new user and the migration are committed together
         c.execute('UPDATE workouts SET user_id = ? WHERE user_id IS NULL', (admin_id,))
         c.execute('UPDATE sessions SET user_id = ? WHERE user_id IS NULL', (admin_id,))
         conn.commit()